@@ -2,6 +2,7 @@ import os
 from random import randint
 import sys
 import asyncio
+import nest_asyncio
 from ib_insync.order import LimitOrder
 from prompt_toolkit.shortcuts import prompt
 import requests
@@ -43,6 +44,10 @@ from trader.messaging.bus import *
 from trader.common.helpers import contract_from_dict
 from trader.common.helpers import *
 
+# commands asyncio.run() against a client whose IB connection is bound to the loop
+# the blocking connect() ran on. nest_asyncio lets asyncio.run reuse that loop
+nest_asyncio.apply()
+
 logging = setup_logging(module_name='cli')
 is_repl = False
 bus_client: BusPath = bus
@@ -9,6 +9,7 @@ sys.path.append(os.path.normpath(os.path.join(SCRIPT_DIR, PACKAGE_PARENT)))
 import logging
 import coloredlogs
 import asyncio
+import nest_asyncio
 from trader.common.logging_helper import setup_logging, suppress_external
 from trader.common.helpers import rich_dict
 
@@ -24,6 +25,10 @@ from typing import AsyncIterator, List, Optional
 from ib_insync.contract import Contract, ContractDetails
 from trader.listeners.ibaiorx import IBAIORx
 
+# IBResolver is driven with asyncio.run() after a blocking client.connect(), and the
+# IB connection stays bound to that loop, so nest_asyncio lets asyncio.run reuse it
+nest_asyncio.apply()
+
 class IBResolver():
     def __init__(
         self,
@@ -15,6 +15,7 @@ import click
 import random
 import os
 import asyncio
+import nest_asyncio
 import time
 
 from typing import List, Dict, Tuple, Callable, Optional, Set, Generic, TypeVar, cast, Union
@@ -26,6 +27,11 @@ from redis import Redis
 from rq import Queue
 
 from trader.common.logging_helper import setup_logging, suppress_all, verbose
+
+# ibrx.connect() binds the IB connection to the current loop, and the later
+# asyncio.run checks have to reuse that loop, which needs nest_asyncio
+nest_asyncio.apply()
+
 logging = setup_logging(module_name='trader_check')
 
 
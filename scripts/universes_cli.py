@@ -4,6 +4,7 @@ import click
 import tempfile
 import click_repl
 import asyncio
+import nest_asyncio
 from dataclasses import asdict
 
 # in order to get __main__ to work, we follow: https://stackoverflow.com/questions/16981921/relative-imports-in-python-3
@@ -22,6 +23,10 @@ from scripts.eoddata_scraper import EodDataScraper
 from scripts.ib_resolve import main as ib_resolve_main
 from prompt_toolkit.history import FileHistory
 
+# bootstrap calls asyncio.run() after a blocking client.connect(). nest_asyncio lets
+# it reuse the loop the IB connection is bound to
+nest_asyncio.apply()
+
 def build_and_load(
     ib_server_address: str,
     ib_server_port: int,
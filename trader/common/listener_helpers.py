@@ -14,10 +14,22 @@ from asyncio import BaseEventLoop
 from ib_insync.ib import IB
 from ib_insync.contract import Stock, Contract, Forex
 from ib_insync.contract import ContractDetails
+from ib_insync.objects import BarData
 from ib_insync.util import df
 from ib_insync.ticker import Ticker
 from trader.common.contract_sink import ContractSink
 
+BAR_DTYPE = np.dtype([
+    ('date', 'datetime64[s]'),
+    ('open', 'f8'),
+    ('high', 'f8'),
+    ('low', 'f8'),
+    ('close', 'f8'),
+    ('volume', 'f8'),
+    ('average', 'f8'),
+    ('bar_count', 'i8'),
+])
+
 class Helpers():
     @staticmethod
     def equity(symbol: str) -> Stock:
@@ -139,6 +151,16 @@ class Helpers():
     def df(t: Ticker) -> pd.DataFrame:
         return df([t])
 
+    @staticmethod
+    def bars_to_arrays(bars: List[BarData]) -> Dict[str, np.ndarray]:
+        # one pass over the BarData objects into a structured array, rather than
+        # ib_insync.util.df's per-object dataclass conversion
+        records = np.array(
+            [(b.date, b.open, b.high, b.low, b.close, b.volume, b.average, b.barCount) for b in bars],
+            dtype=BAR_DTYPE
+        )
+        return {name: records[name] for name in cast(Tuple[str, ...], BAR_DTYPE.names)}
+
     @staticmethod
     def rolling_linreg(df, window=90):
         '''
@@ -208,21 +208,17 @@ class AsyncEventSubject(AsyncCachedSubject[TSource]):
         if result:
             await self.asend(result)
 
-    def call_event_subscriber_sync(self, callable_lambda: Callable):
+    async def call_event_subscriber_fn(self, callable_lambda: Callable):
+        # the subscriber itself is synchronous, but we're already running on the
+        # event loop, so await the asend rather than spinning up a nested loop
         result = callable_lambda()
         if result:
-            print('call_event_subscriber_sync')
-            test = asyncio.run(self.asend(result))
-            print('done')
+            await self.asend(result)
 
     async def call_cancel_subscription(self, awaitable_canceller: Awaitable):
         await awaitable_canceller
         await self.aclose()
 
-    def call_cancel_subscription_sync(self, callable_lambda: Callable):
-        callable_lambda()
-        asyncio.run(self.aclose())
-
     async def on_eventkit_update(self, e: TSource, *args):
         await self.asend(e)
 
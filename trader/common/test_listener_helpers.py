@@ -0,0 +1,59 @@
+import datetime as dt
+import numpy as np
+import pandas as pd
+from ib_insync import util
+from ib_insync.objects import BarData
+from trader.common.listener_helpers import Helpers
+
+
+def bars(dates):
+    return [
+        BarData(date=d, open=10.0 + i, high=11.0 + i, low=9.0 + i, close=10.5 + i,
+                volume=1000.0 * (i + 1), average=10.25 + i, barCount=100 + i)
+        for i, d in enumerate(dates)
+    ]
+
+
+def old_frame(result):
+    # what IBHistoryWorker built before bars_to_arrays
+    df = util.df(result).set_index('date')
+    df.rename({'barCount': 'bar_count'}, inplace=True, axis=1)
+    df.index = pd.to_datetime(df.index)
+    df.index = df.index.astype('datetime64[ns]')
+    return df
+
+
+def new_frame(result):
+    df = pd.DataFrame(Helpers.bars_to_arrays(result)).set_index('date')
+    df.index = pd.to_datetime(df.index)
+    df.index = df.index.astype('datetime64[ns]')
+    return df
+
+
+def assert_same_frame(result):
+    old = old_frame(result)
+    new = new_frame(result)
+
+    assert list(new.columns) == list(old.columns)
+    assert 'bar_count' in new.columns
+    assert new['bar_count'].dtype == np.int64
+    assert new.index.equals(old.index)
+    pd.testing.assert_frame_equal(new, old, check_dtype=False)
+
+
+def test_bars_to_arrays_daily():
+    # daily bars come back as datetime.date
+    result = bars([dt.date(2021, 3, 1), dt.date(2021, 3, 2), dt.date(2021, 3, 3)])
+    assert_same_frame(result)
+
+
+def test_bars_to_arrays_intraday():
+    # intraday bars with formatDate=1 come back as naive datetime.datetime
+    result = bars([dt.datetime(2021, 3, 1, 9, 30), dt.datetime(2021, 3, 1, 9, 31), dt.datetime(2021, 3, 1, 9, 32)])
+    assert_same_frame(result)
+
+
+def test_bars_to_arrays_empty():
+    arrays = Helpers.bars_to_arrays([])
+    assert list(arrays.keys()) == ['date', 'open', 'high', 'low', 'close', 'volume', 'average', 'bar_count']
+    assert all(len(a) == 0 for a in arrays.values())
@@ -1,6 +1,7 @@
 from re import I
+import asyncio
+import time
 import datetime as dt
-import ib_insync
 import pandas as pd
 import numpy as np
 import backoff
@@ -10,8 +11,9 @@ from rq import Queue
 from arctic.exceptions import OverlappingDataException
 from ib_insync.contract import Contract
 from dateutil.tz import tzlocal, gettz
-from typing import Tuple, List, Optional, cast, Union
+from typing import Tuple, List, Optional, cast, Union, Deque
 from functools import reduce
+from collections import deque
 
 from trader.data.data_access import SecurityDefinition, TickData
 from trader.data.universe import Universe
@@ -24,9 +26,31 @@ from ib_insync.ib import IB
 
 logging = setup_logging(module_name='ibhistoryworker')
 
+class HistoricalDataPacer():
+    # TWS allows at most 60 historical data requests in any 10 minute window,
+    # callers share one of these and acquire() before every reqHistoricalData
+    def __init__(self, max_requests: int = 60, window_seconds: float = 600.0):
+        self.max_requests = max_requests
+        self.window_seconds = window_seconds
+        self.requests: Deque[float] = deque()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                while self.requests and now - self.requests[0] >= self.window_seconds:
+                    self.requests.popleft()
+                if len(self.requests) < self.max_requests:
+                    self.requests.append(now)
+                    return
+                await asyncio.sleep(self.window_seconds - (now - self.requests[0]))
+
+
 class IBHistoryWorker():
-    def __init__(self, ib_client: IB):
+    def __init__(self, ib_client: IB, pacer: Optional[HistoricalDataPacer] = None):
         self.ib_client = ib_client
+        self.pacer = pacer
         self.error_code: int = 0
         self.error_string: str = ''
         self.error_contract: Optional[Contract] = None
@@ -106,6 +130,9 @@ class IBHistoryWorker():
         bars: List[pd.DataFrame] = []
 
         while current_date >= start_date:
+            if self.pacer:
+                await self.pacer.acquire()
+
             result = await self.ib_client.reqHistoricalDataAsync(
                 contract,
                 endDateTime=current_date,
@@ -122,10 +149,9 @@ class IBHistoryWorker():
                 raise Exception('error_code: {}'.format(self.error_code))
 
             if result:
-                df_result = ib_insync.util.df(result).set_index('date')
+                df_result = pd.DataFrame(Helpers.bars_to_arrays(result)).set_index('date')
                 df_result['bar_size'] = bar_size
                 df_result['what_to_show'] = what_to_show
-                df_result.rename({'barCount': 'bar_count'}, inplace=True, axis=1)
 
                 # arctic requires timezone to be set
                 df_result.index = pd.to_datetime(df_result.index)  # type: ignore
@@ -1,6 +1,7 @@
 # the fundamentals of asyncio: https://www.integralist.co.uk/posts/python-asyncio/
 
 import os
+import math
 import asyncio
 import datetime
 from re import I
@@ -52,11 +53,10 @@ from typing import (
 )
 
 from trader.common.listener_helpers import Helpers
-from trader.common.helpers import Pipe
 from trader.common.logging_helper import setup_logging
-from trader.common.reactive import AsyncCachedSubject, AsyncCachedPandasSubject, AsyncCachedObserver
+from trader.common.reactive import AsyncCachedSubject, AsyncCachedPandasSubject
 from trader.common.reactive import AsyncCachedObservable, awaitify, AsyncEventSubject
-from trader.listeners.ib_history_worker import IBHistoryWorker
+from trader.listeners.ib_history_worker import IBHistoryWorker, HistoricalDataPacer
 from trader.objects import WhatToShow, ReportType
 
 logging = setup_logging(module_name="ibaiorx")
@@ -82,9 +82,14 @@ class IBAIORx():
         self.ib_server_port = ib_server_port
         self.read_only = read_only
 
-        nest_asyncio.apply()
+        # the trader runtime sits on a single event loop; only patch in re-entrant
+        # loops when asked for (the cli tools and Jupyter apply it themselves)
+        if os.getenv('ALLOW_NESTED_LOOPS'):
+            nest_asyncio.apply()
 
         self.ib = IB()
+        # TWS serves live data (1) until reqMarketDataType says otherwise
+        self.market_data_type: int = 1
 
         def mapper(tickers: Set[Ticker]) -> rx.AsyncObservable[Ticker]:
             return rx.from_iterable(tickers)
@@ -106,6 +111,8 @@ class IBAIORx():
         self.contracts_cache: Dict[Contract, rx.AsyncObservable] = {}
         self.bars_cache: Dict[Contract, rx.AsyncObservable[RealTimeBarList]] = {}
         self.historical_subscribers: Dict[Contract, int] = {}
+        # every historical data request from this client (including refreshes) goes through here
+        self.history_pacer = HistoricalDataPacer()
 
         # try binding helper methods to things we care about
         Contract.to_df = Helpers.to_df  # type: ignore
@@ -122,8 +129,12 @@ class IBAIORx():
             )
         )
 
-    @backoff.on_exception(backoff.expo, Exception, max_tries=3, max_time=30)
     def connect(self):
+        # drive the async connect to completion, so the clientId handling lives in one place
+        return self.ib.run(self.connect_async())
+
+    @backoff.on_exception(backoff.expo, Exception, max_tries=3, max_time=30)
+    async def connect_async(self):
         def __handle_client_id_error(msg):
             logging.error('clientId already in use, randomizing and trying again')
             IBAIORx.client_id_counter = random.randint(10, 99)
@@ -138,7 +149,7 @@ class IBAIORx():
         net_client = cast(Client, self.ib.client)
         net_client.conn.disconnected += __handle_client_id_error
 
-        self.ib.connect(
+        await self.ib.connectAsync(
             self.ib_server_address,
             self.ib_server_port,
             clientId=IBAIORx.client_id_counter,
@@ -156,6 +167,11 @@ class IBAIORx():
     def is_connected(self):
         return self.ib.isConnected()
 
+    def req_market_data_type(self, market_data_type: int):
+        # tracked, so temporary switches to delayed data can restore the session's type
+        self.market_data_type = market_data_type
+        self.ib.reqMarketDataType(market_data_type)
+
     def _filter_contract(self, contract: Contract, data) -> bool:
         if data.contract:
             return data.contract.conId == contract.conId
@@ -181,7 +197,7 @@ class IBAIORx():
         )
 
         disposable = await xs.subscribe_async(observer)
-        self.trades_subject.call_event_subscriber_sync(lambda: self.ib.placeOrder(contract, order))
+        await self.trades_subject.call_event_subscriber_fn(lambda: self.ib.placeOrder(contract, order))
         # todo, figure out what to do here with the disposable
         # should it cancel the order, or just stop listening?
         return disposable
@@ -198,7 +214,7 @@ class IBAIORx():
         )
 
         disposable = await xs.subscribe_async(observer)
-        self.trades_subject.call_event_subscriber_sync(lambda: self.ib.cancelOrder(order))
+        await self.trades_subject.call_event_subscriber_fn(lambda: self.ib.cancelOrder(order))
 
         return disposable
 
@@ -216,7 +232,7 @@ class IBAIORx():
             logging.debug('reqMarketDataType(3)')
             self.ib.reqMarketDataType(3)
 
-        self._contracts_source.call_event_subscriber_sync(
+        await self._contracts_source.call_event_subscriber_fn(
             lambda: self.ib.reqMktData(
                 contract=contract,
                 genericTickList='',
@@ -261,7 +277,7 @@ class IBAIORx():
         if contract in self.bars_cache:
             return self.bars_cache[contract]
 
-        self.bars_data_subject.call_event_subscriber_sync(
+        await self.bars_data_subject.call_event_subscriber_fn(
             lambda: self.ib.reqRealTimeBars(contract, bar_size, str(wts), False)
         )
 
@@ -299,30 +315,36 @@ class IBAIORx():
     async def get_executions(self) -> List[Fill]:
         return await self.ib.reqExecutionsAsync()
 
-    async def get_snapshot(self, contract: Contract, delayed: bool = False) -> Ticker:
-        populated_ticker: Ticker = Ticker()
+    async def get_snapshot(self, contract: Contract, delayed: bool = False, timeout: float = 10.0) -> Ticker:
+        # resolves on the first ticker with a bid, without building a reactive pipeline.
+        # raises asyncio.TimeoutError if no bid turns up (no permissions, halted etc)
+        future: asyncio.Future[Ticker] = asyncio.get_running_loop().create_future()
+
+        def update_ticker(ticker: Ticker):
+            if not future.done() and not math.isnan(ticker.bid):
+                future.set_result(ticker)
 
-        async def update_ticker(ticker: Ticker):
-            populated_ticker = ticker
+        previous_market_data_type = self.market_data_type
+        switch_to_delayed = delayed and previous_market_data_type != 3
+        if switch_to_delayed:
+            self.req_market_data_type(3)
 
-        # we've got to subscribe, then wait for the first Ticker to arrive in the events
-        # cachedeventsource, subscribers get the last value after calling subscribe
-        observable = await self.__subscribe_contract(
+        ticker = self.ib.reqMktData(
             contract=contract,
-            one_time_snapshot=True,
-            delayed=delayed,
+            genericTickList='',
+            snapshot=True,
+            regulatorySnapshot=False,
+            mktDataOptions=None
         )
 
-        cached_observer = AsyncCachedObserver(asend=update_ticker)
+        if switch_to_delayed:
+            self.req_market_data_type(previous_market_data_type)
 
-        xs = pipe(
-            observable,
-            Pipe[Ticker].take(1)
-        )
-
-        disposable = await xs.subscribe_async(cached_observer)
-        # todo if we error out here, we're waiting forever.
-        return await cached_observer.wait_value()
+        ticker.updateEvent += update_ticker
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            ticker.updateEvent -= update_ticker
 
     async def get_contract_details(self, contract: Contract) -> List[ContractDetails]:
         result = await self.ib.reqContractDetailsAsync(contract)
@@ -448,7 +470,7 @@ class IBAIORx():
         bar_size: str = '1 min',
         what_to_show: WhatToShow = WhatToShow.MIDPOINT,
     ) -> pd.DataFrame:
-        history_worker = IBHistoryWorker(self.ib)
+        history_worker = IBHistoryWorker(self.ib, pacer=self.history_pacer)
         return await history_worker.get_contract_history(
             security=contract,
             what_to_show=what_to_show,
@@ -502,6 +524,30 @@ class IBAIORx():
         loop.call_later(1, asyncio.create_task, __update(subject, contract, start_date, end_date))
         return await subject.subscribe_async(observer)
 
+    async def subscribe_contracts_history(
+        self,
+        contracts: List[Contract],
+        start_date: dt.datetime,
+        what_to_show: WhatToShow,
+        observers: List[AsyncObserver[pd.DataFrame]],
+        refresh_interval: int = 60,
+    ) -> List[AsyncDisposable]:
+        if len(contracts) != len(observers):
+            raise ValueError('contracts and observers must be the same length')
+
+        # subscribing doesn't touch TWS; the history requests themselves are paced
+        # through self.history_pacer
+        disposables: List[AsyncDisposable] = []
+        for contract, observer in zip(contracts, observers):
+            disposables.append(await self.subscribe_contract_history(
+                contract=contract,
+                start_date=start_date,
+                what_to_show=what_to_show,
+                observer=observer,
+                refresh_interval=refresh_interval,
+            ))
+        return disposables
+
     def sleep(self, seconds: float):
         self.ib.sleep(seconds)
 
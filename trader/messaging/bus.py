@@ -5,7 +5,7 @@ from ib_insync.objects import Position, PortfolioItem
 from ib_insync.contract import Contract
 from ib_insync.order import Order, Trade
 from trader.container import Container
-from trader.trading.trading_runtime import Action, Trader
+from trader.trading.trading_runtime import Action, get_trader
 from trader.data.universe import Universe
 from trader.common.helpers import DictHelper
 
@@ -17,7 +17,7 @@ class TraderServiceApi(Api):
     # state of the trading system.
     # If it's resolved from outside the runtime (i.e. from bus.py import *) it still
     # fires up properly.
-    trader = Container().resolve(Trader)
+    trader = get_trader()
 
     class Meta:
         name = 'service'
@@ -6,7 +6,6 @@ from ib_insync.objects import Position, PortfolioItem
 from ib_insync.contract import Contract
 from ib_insync.order import Trade, Order, OrderStatus
 from trader.common.logging_helper import setup_logging
-from trader.common.helpers import ListHelper
 from trader.common.reactive import AsyncCachedSubject, AsyncEventSubject
 from eventkit import Event
 
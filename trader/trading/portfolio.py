@@ -6,7 +6,6 @@ from expression.collections import seq, Seq
 from ib_insync.objects import Position, PortfolioItem
 from ib_insync.contract import Contract
 from trader.common.logging_helper import setup_logging
-from trader.common.helpers import ListHelper
 
 logging = setup_logging(module_name='portfolio')
 
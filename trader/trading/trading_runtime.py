@@ -1,38 +1,39 @@
+from __future__ import annotations
+
 import sys
 import os
-import nest_asyncio
 
 from trader.objects import WhatToShow
-nest_asyncio.apply()
+
+# the trader runs on a single long-lived event loop, so only patch in re-entrant
+# loops when explicitly asked for (i.e. driving the Trader from Jupyter)
+if os.getenv('ALLOW_NESTED_LOOPS'):
+    import nest_asyncio
+    nest_asyncio.apply()
 
 # in order to get __main__ to work, we follow: https://stackoverflow.com/questions/16981921/relative-imports-in-python-3
 PACKAGE_PARENT = '../..'
 SCRIPT_DIR = os.path.dirname(os.path.realpath(os.path.join(os.getcwd(), os.path.expanduser(__file__))))
 sys.path.append(os.path.normpath(os.path.join(SCRIPT_DIR, PACKAGE_PARENT)))
 
-import pandas as pd
+import asyncio
 import datetime as dt
 import backoff
 import aioreactive as rx
 
 from asyncio.events import AbstractEventLoop
 from aioreactive.types import AsyncObservable, Projection
-from expression.core import pipe
 from aioreactive.observers import AsyncAnonymousObserver
 from enum import Enum
+from dataclasses import dataclass
+from dateutil.tz import gettz
 
 from trader.common.logging_helper import setup_logging
 logging = setup_logging(module_name='trading_runtime')
 
-from arctic import Arctic, TICK_STORE
-from arctic.date import DateRange
-from arctic.tickstore.tickstore import TickStore
 from ib_insync.ib import IB
 from ib_insync.contract import Contract, Forex, Future, Stock
-from ib_insync.objects import PortfolioItem, Position, BarData
 from ib_insync.order import LimitOrder, Order, Trade
-from ib_insync.util import df
-from ib_insync.ticker import Ticker
 from eventkit import Event
 
 from trader.listeners.ibaiorx import IBAIORx
@@ -48,12 +49,16 @@ from trader.trading.portfolio import Portfolio
 from trader.trading.executioner import Executioner
 from trader.trading.strategy import Strategy
 from trader.common.reactive import AsyncCachedObserver, AsyncEventSubject, AsyncCachedSubject
-from trader.common.singleton import Singleton
-from trader.common.helpers import get_network_ip, Pipe, dateify, timezoneify, ListHelper
+from trader.common.helpers import get_network_ip, dateify, timezoneify
 from trader.messaging.bus_server import start_lightbus
 from trader.data.market_data import MarketData, SecurityDataStream
 
-from typing import List, Dict, Tuple, Callable, Optional, Set, Generic, TypeVar, cast, Union
+from typing import List, Dict, Tuple, Callable, Optional, Set, Generic, TypeVar, cast, Union, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from ib_insync.contract import ContractDetails
+    from ib_insync.objects import PortfolioItem, Position, BarData
+    from ib_insync.ticker import Ticker
 
 # notes
 # https://groups.io/g/insync/topic/using_reqallopenorders/27261173?p=,,,20,0,0,0::recentpostdate%2Fsticky,,,20,2,0,27261173
@@ -64,11 +69,31 @@ class Action(Enum):
     SELL = 2
 
     def __str__(self):
-        if self.value == 1: return 'BUY'
-        if self.value == 2: return 'SELL'
+        return self.name
+
+
+# order actions as the strings ib_insync orders expect, computed once at import
+_ACTION_STR: Dict[Action, str] = {action: str(action) for action in Action}
+# how far away from the bid debug orders are placed, so they don't fill
+_DEBUG_MULT: Dict[Action, float] = {Action.BUY: 0.9, Action.SELL: 1.1}
+
+
+# parsed once, rather than on every timezoneify call
+_NEW_YORK = gettz('America/New_York')
+
+
+def _key(contract: Contract) -> int:
+    # the same instrument can arrive as different Contract objects (with or without
+    # exchange etc populated), so we key all our subscription dicts on conId
+    return contract.conId
 
 
-class Trader(metaclass=Singleton):
+@dataclass
+class PortfolioUpdate:
+    contract: Contract
+
+
+class Trader():
     def __init__(self,
                  ib_server_address: str,
                  ib_server_port: int,
@@ -95,10 +120,24 @@ class Trader(metaclass=Singleton):
         self.data: TickData
         self.universe_accessor: UniverseAccessor
 
-        # the live ticker data streams we have
-        self.contract_subscriptions: Dict[Contract, ContractSink] = {}
-        # the minute-by-minute MarketData stream's we're subscribed to
-        self.market_data_subscriptions: Dict[SecurityDefinition, SecurityDataStream] = {}
+        # the live ticker data streams we have, keyed by conId
+        self.contract_subscriptions: Dict[int, ContractSink] = {}
+        # the minute-by-minute MarketData stream's we're subscribed to, keyed by conId
+        self.market_data_subscriptions: Dict[int, SecurityDataStream] = {}
+        # conId indexes for the 'portfolio' universe and market data subscriptions,
+        # so the portfolio update path doesn't have to scan lists
+        self._universe_conids: Set[int] = set()
+        self._subscribed_conids: Set[int] = set()
+        # cached copy of the 'portfolio' universe, written back to arctic when dirty
+        self._portfolio_universe: Optional[Universe] = None
+        self._portfolio_universe_dirty: bool = False
+        self._portfolio_universe_flush: Optional[asyncio.Task] = None
+        self._portfolio_universe_flush_delay: float = 0.5
+        # contract details are immutable for a conId, so only ask TWS once per process (this
+        # survives reconnects). Holds the lookup task, so concurrent misses share one request
+        self._contract_details_cache: Dict[int, asyncio.Future] = {}
+        # market data streams waiting on a bulk historical data subscription
+        self._pending_history: Dict[int, Tuple[Contract, SecurityDataStream]] = {}
         # the strategies we're using
         self.strategies: List[Strategy] = []
         # current order book (outstanding orders, trades etc)
@@ -113,16 +152,31 @@ class Trader(metaclass=Singleton):
 
     @backoff.on_exception(backoff.expo, ConnectionRefusedError, max_tries=10, max_time=120)
     def connect(self):
-        self.client = IBAIORx(self.ib_server_address, self.ib_server_port)
         self.data = TickData(self.arctic_server_address, self.arctic_library)
         self.universe_accessor = UniverseAccessor(self.arctic_server_address, self.arctic_universe_library)
         self.universes = self.universe_accessor.get_all()
+        self._reset_connection_state()
+        self.client.connect()
+
+    @backoff.on_exception(backoff.expo, ConnectionRefusedError, max_tries=10, max_time=120)
+    async def _reconnect_async(self):
+        # we're already inside the event loop here, so reconnect without blocking on it
+        self.client.ib.connectedEvent -= self.connected_event
+        self.client.ib.disconnectedEvent -= self.disconnected_event
+        self._reset_connection_state()
+        await self.client.connect_async()
+
+    def _reset_connection_state(self):
+        # a fresh client means fresh subjects, so the observers setup_subscriptions
+        # attaches don't pile up across reconnects
+        self.client = IBAIORx(self.ib_server_address, self.ib_server_port)
         self.clear_portfolio_universe()
         self.contract_subscriptions = {}
         self.market_data_subscriptions = {}
+        self._subscribed_conids = set()
+        self._pending_history = {}
         self.client.ib.connectedEvent += self.connected_event
         self.client.ib.disconnectedEvent += self.disconnected_event
-        self.client.connect()
 
     def reconnect(self):
         # this will force a reconnect through the disconnected event
@@ -169,13 +223,31 @@ class Trader(metaclass=Singleton):
                                                             athrow=handle_subscription_exception,
                                                             capture_asend_exception=True))
 
+        # hydrate the portfolio universe in one batch, rather than a contract details
+        # round trip and universe write for every portfolio item
+        portfolio_items = self.client.ib.portfolio()
+        updates: Dict[int, PortfolioUpdate] = {}
+        for p in portfolio_items:
+            update = self._plan_portfolio_update(p)
+            if update:
+                updates[_key(update.contract)] = update
+        # like the portfolio observer, log and carry on if hydration fails, so the
+        # rest of the subscriptions (market data type, open orders) still get setup
+        try:
+            start_date, end_date = self._history_window()
+            await self._apply_portfolio_updates(list(updates.values()), start_date, end_date)
+            self._flush_portfolio_universe()
+            await self._subscribe_pending_history(start_date)
+        except Exception as ex:
+            logging.exception(ex)
+
         # because the portfolio subscription is synchronous, an observer isn't attached
-        # as the ib.portfolio() method is called, so call it again
-        for p in self.client.ib.portfolio():
-            await self.client.portfolio_subject.asend(p)
+        # as the ib.portfolio() method is called, so call it again. The universe is
+        # already hydrated, so these are independent and can be sent concurrently
+        await asyncio.gather(*[self.client.portfolio_subject.asend(p) for p in portfolio_items])
 
         # make sure we're getting either live, or delayed data
-        self.client.ib.reqMarketDataType(self.market_data)
+        self.client.req_market_data_type(self.market_data)
 
         orders = await self.client.ib.reqAllOpenOrdersAsync()
         for o in orders:
@@ -187,56 +259,157 @@ class Trader(metaclass=Singleton):
 
     async def disconnected_event(self):
         logging.debug('disconnected_event')
-        self.connect()
+        await self._reconnect_async()
 
     def clear_portfolio_universe(self):
         logging.debug('clearing portfolio universe')
         universe = self.universe_accessor.get('portfolio')
         universe.security_definitions.clear()
         self.universe_accessor.update(universe)
+        self._portfolio_universe = universe
+        self._portfolio_universe_dirty = False
+        self._universe_conids = set()
+
+    def _get_portfolio_universe(self) -> Universe:
+        if self._portfolio_universe is None:
+            self._portfolio_universe = self.universe_accessor.get('portfolio')
+        return self._portfolio_universe
+
+    def _flush_portfolio_universe(self):
+        if self._portfolio_universe is not None and self._portfolio_universe_dirty:
+            logging.debug('writing portfolio universe')
+            self.universe_accessor.update(self._portfolio_universe)
+            self._portfolio_universe_dirty = False
+
+    async def _debounce_flush_portfolio_universe(self):
+        # coalesce the universe writes from a burst of portfolio updates into one
+        await asyncio.sleep(self._portfolio_universe_flush_delay)
+        self._portfolio_universe_flush = None
+        self._flush_portfolio_universe()
+
+    def _schedule_portfolio_universe_flush(self):
+        if self._portfolio_universe_flush is None:
+            self._portfolio_universe_flush = asyncio.create_task(self._debounce_flush_portfolio_universe())
 
     async def update_portfolio_universe(self, portfolio_item: PortfolioItem):
         """
         Grabs the current portfolio from TWS and adds a new version to the 'portfolio' table.
         """
-        universe = self.universe_accessor.get('portfolio')
-        if not ListHelper.isin(
-            universe.security_definitions,
-            lambda definition: definition.conId == portfolio_item.contract.conId
-        ):
-            contract = portfolio_item.contract
-            contract_details = await self.client.get_contract_details(contract)
-            if contract_details and len(contract_details) >= 1:
-                universe.security_definitions.append(
-                    SecurityDefinition.from_contract_details(contract_details[0])
-                )
-
+        update = self._plan_portfolio_update(portfolio_item)
+        if update:
             logging.debug('updating portfolio universe with {}'.format(portfolio_item))
-            self.universe_accessor.update(universe)
-
-            if not ListHelper.isin(
-                list(self.market_data_subscriptions.keys()),
-                lambda subscription: subscription.conId == portfolio_item.contract.conId
-            ):
-                logging.debug('subscribing to market data stream for portfolio item {}'.format(portfolio_item.contract))
-                security = cast(SecurityDefinition, universe.find_contract(portfolio_item.contract))
-                date_range = DateRange(
-                    start=dateify(dt.datetime.now() - dt.timedelta(days=30)),
-                    end=timezoneify(dt.datetime.now(), timezone='America/New_York')
-                )
-                security_stream = SecurityDataStream(
-                    security=security,
-                    bar_size='1 min',
-                    date_range=date_range,
-                    existing_data=None
-                )
-                await self.client.subscribe_contract_history(
-                    contract=portfolio_item.contract,
-                    start_date=dateify(dt.datetime.now() - dt.timedelta(days=30)),
-                    what_to_show=WhatToShow.TRADES,
-                    observer=security_stream
-                )
-                self.market_data_subscriptions[security] = security_stream
+            start_date, end_date = self._history_window()
+            await self._apply_portfolio_updates([update], start_date, end_date)
+            self._schedule_portfolio_universe_flush()
+            await self._subscribe_pending_history(start_date)
+
+    def _plan_portfolio_update(self, portfolio_item: PortfolioItem) -> Optional[PortfolioUpdate]:
+        conid = _key(portfolio_item.contract)
+        if conid in self._universe_conids:
+            return None
+        return PortfolioUpdate(contract=portfolio_item.contract)
+
+    def _history_window(self) -> Tuple[dt.datetime, dt.datetime]:
+        # the 30 day window of 1 min bars we backfill portfolio market data streams with
+        now = dt.datetime.now()
+        return (dateify(now - dt.timedelta(days=30)), timezoneify(now, timezone=_NEW_YORK))
+
+    async def _apply_portfolio_updates(
+        self,
+        updates: List[PortfolioUpdate],
+        start_date: dt.datetime,
+        end_date: dt.datetime
+    ):
+        if not updates:
+            return
+
+        universe = self._get_portfolio_universe()
+        results = await asyncio.gather(*[self._get_contract_details_cached(u.contract) for u in updates])
+        # the definitions we add here, so we don't have to scan the universe to find them again.
+        # anything already in the universe was added (and queued) by an earlier update
+        definitions: Dict[int, SecurityDefinition] = {}
+        for update, contract_details in zip(updates, results):
+            conid = _key(update.contract)
+            if contract_details and len(contract_details) >= 1 and conid not in self._universe_conids:
+                definition = SecurityDefinition.from_contract_details(contract_details[0])
+                universe.security_definitions.append(definition)
+                definitions[conid] = definition
+                self._universe_conids.add(conid)
+                self._portfolio_universe_dirty = True
+
+        for update in updates:
+            conid = _key(update.contract)
+            if conid in self._subscribed_conids or conid in self._pending_history:
+                continue
+            security = definitions.get(conid)
+            if not security:
+                logging.debug('no security definition found for {}, not subscribing'.format(update.contract))
+                continue
+            self._queue_security_stream(update.contract, security, start_date, end_date)
+
+    async def _get_contract_details_cached(self, contract: Contract) -> List[ContractDetails]:
+        conid = _key(contract)
+        lookup = self._contract_details_cache.get(conid)
+        if lookup is None:
+            lookup = asyncio.ensure_future(self.client.get_contract_details(contract))
+            self._contract_details_cache[conid] = lookup
+
+            def evict_failed(done: asyncio.Future):
+                # don't cache failed or empty lookups, so we try again on the next update
+                failed = done.cancelled() or done.exception() is not None or not done.result()
+                if failed and self._contract_details_cache.get(conid) is done:
+                    del self._contract_details_cache[conid]
+
+            lookup.add_done_callback(evict_failed)
+
+        # shield, so one cancelled caller doesn't cancel the lookup for everyone sharing it
+        return await asyncio.shield(lookup)
+
+    def _queue_security_stream(
+        self,
+        contract: Contract,
+        security: SecurityDefinition,
+        start_date: dt.datetime,
+        end_date: dt.datetime
+    ):
+        from arctic.date import DateRange
+
+        logging.debug('queuing market data stream for portfolio item {}'.format(contract))
+        date_range = DateRange(start=start_date, end=end_date)
+        security_stream = SecurityDataStream(
+            security=security,
+            bar_size='1 min',
+            date_range=date_range,
+            existing_data=None
+        )
+        self._pending_history[security.conId] = (contract, security_stream)
+
+    async def _subscribe_pending_history(self, start_date: dt.datetime):
+        if not self._pending_history:
+            return
+
+        pending = self._pending_history
+        self._pending_history = {}
+
+        # mark these as subscribed before we await, so a concurrent portfolio update
+        # for the same conId doesn't queue a second stream while we're subscribing
+        for conid, (_, stream) in pending.items():
+            self.market_data_subscriptions[conid] = stream
+            self._subscribed_conids.add(conid)
+
+        logging.debug('subscribing to {} market data streams'.format(len(pending)))
+        try:
+            await self.client.subscribe_contracts_history(
+                contracts=[contract for contract, _ in pending.values()],
+                start_date=start_date,
+                what_to_show=WhatToShow.TRADES,
+                observers=[stream for _, stream in pending.values()]
+            )
+        except Exception:
+            for conid in pending:
+                self.market_data_subscriptions.pop(conid, None)
+                self._subscribed_conids.discard(conid)
+            raise
 
     async def temp_place_order(
         self,
@@ -269,16 +442,7 @@ class Trader(metaclass=Singleton):
         # todo make sure amount is less than outstanding profit
 
         # grab the latest price of instrument
-        subject = await self.client.subscribe_contract(contract=contract, one_time_snapshot=True)
-
-        xs = pipe(
-            subject,
-            Pipe[Ticker].take(1)
-        )
-
-        observer = AsyncCachedObserver[Ticker]()
-        await xs.subscribe_async(observer)
-        latest_tick = await observer.wait_value()
+        latest_tick = await self.client.get_snapshot(contract, delayed=delayed)
 
         # todo perform tick sanity checks
 
@@ -297,14 +461,11 @@ class Trader(metaclass=Singleton):
 
         limit_price = latest_tick.bid
         # if debug, move the buy/sell by 10%
-        if debug and action == Action.BUY:
-            limit_price = limit_price * 0.9
-            limit_price = round(limit_price * 0.9, ndigits=2)
-        if debug and action == Action.SELL:
-            limit_price = round(limit_price * 1.1, ndigits=2)
+        if debug:
+            limit_price = round(limit_price * _DEBUG_MULT[action], ndigits=2)
 
         # put an order in
-        order = LimitOrder(action=str(action), totalQuantity=quantity_int, lmtPrice=limit_price)
+        order = LimitOrder(action=_ACTION_STR[action], totalQuantity=quantity_int, lmtPrice=limit_price)
         return await self.temp_place_order(contract=contract, order=order)
 
     def cancel_order(self, order_id: int) -> Optional[Trade]:
@@ -338,3 +499,14 @@ class Trader(metaclass=Singleton):
 
     def run(self):
         self.client.run()
+
+
+# the process wide trader instance, resolved from the Container on first use
+_trader: Optional[Trader] = None
+
+
+def get_trader(**kwargs) -> Trader:
+    global _trader
+    if _trader is None:
+        _trader = Container().resolve(Trader, **kwargs)
+    return _trader
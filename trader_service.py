@@ -1,13 +1,11 @@
 import click
-import nest_asyncio
-nest_asyncio.apply()
 import asyncio
 
 from trader.common.logging_helper import setup_logging
 logging = setup_logging(module_name='trading_runtime')
 
 from trader.container import Container
-from trader.trading.trading_runtime import Trader
+from trader.trading.trading_runtime import get_trader
 from trader.common.helpers import get_network_ip
 from trader.messaging.bus_server import start_lightbus
 
@@ -17,7 +15,6 @@ from trader.messaging.bus_server import start_lightbus
               help='trader.yaml config file location')
 def main(simulation: bool,
          config: str):
-    # required for nested asyncio calls and avoids RuntimeError: This event loop is already running
     loop = asyncio.get_event_loop()
 
     if simulation:
@@ -25,7 +22,7 @@ def main(simulation: bool,
         # ib_client = HistoricalIB(logger=logging)
 
     container = Container(config)
-    trader = container.resolve(Trader, simulation=simulation)
+    trader = get_trader(simulation=simulation)
     trader.connect()
 
     ip_address = get_network_ip()